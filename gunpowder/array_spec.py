@@ -1,4 +1,3 @@
-import copy
 from .coordinate import Coordinate
 from .freezable import Freezable
 
@@ -83,7 +82,21 @@ class ArraySpec(Freezable):
 
     def copy(self):
         '''Create a copy of this spec.'''
-        return copy.deepcopy(self)
+
+        # all attributes but the ROI are immutable and can be shared
+        return ArraySpec(
+            roi=None if self.roi is None else self.roi.copy(),
+            voxel_size=self.voxel_size,
+            interpolatable=self.interpolatable,
+            nonspatial=self.nonspatial,
+            dtype=self.dtype,
+            placeholder=self.placeholder)
+
+    def __copy__(self):
+        return self.copy()
+
+    def __deepcopy__(self, memo):
+        return self.copy()
 
     def __eq__(self, other):
 
@@ -1,19 +1,48 @@
 import logging
-import random
 import numpy as np
 
 # imports for deformed slice
 from skimage.draw import line
-from scipy.ndimage.measurements import label
 from scipy.ndimage.interpolation import map_coordinates
 from scipy.ndimage.morphology import binary_dilation
 
 from gunpowder.batch_request import BatchRequest
 from gunpowder.coordinate import Coordinate
+from gunpowder.ext import torch, NoSuchModule
 from .batch_filter import BatchFilter
 
 logger = logging.getLogger(__name__)
 
+# the types of augmentation a section can be assigned to
+ZERO_OUT, LOWER_CONTRAST, ARTIFACT, DEFORMED_SLICE = range(4)
+
+
+def _fill_flow(shape, start, end, normal_vector, strength):
+    '''Create the sampling coordinates ``(flow_y, flow_x)`` as one
+    ``(2, height, width)`` array for a section of the given shape, such that
+    voxels on the positive side of the line from ``start`` to ``end`` get
+    shifted by ``strength`` along ``normal_vector`` and voxels on the negative
+    side in the opposite direction.'''
+
+    # voxel coordinates, broadcast against each other instead of a dense grid
+    rows = np.arange(shape[0], dtype=np.float32)[:, None]
+    cols = np.arange(shape[1], dtype=np.float32)[None, :]
+
+    # the side of the line a voxel is on is given by the sign of the cross
+    # product of the line vector and the vector from start to the voxel
+    side = np.sign(
+        (end[0] - start[0]) * (cols - start[1]) -
+        (end[1] - start[1]) * (rows - start[0]))
+
+    flow = np.empty((2,) + tuple(shape), dtype=np.float32)
+    np.multiply(side, strength * normal_vector[0], out=flow[0])
+    np.multiply(side, strength * normal_vector[1], out=flow[1])
+    flow[0] += rows
+    flow[1] += cols
+
+    return flow
+
+
 class DefectAugment(BatchFilter):
     '''Augment intensity arrays section-wise with artifacts like missing
     sections, low-contrast sections, by blending in artifacts drawn from a
@@ -56,12 +85,28 @@ class DefectAugment(BatchFilter):
             The key to query ``artifact_source`` for to get the alpha mask
             of the artifacts to blend them with ``intensities``.
 
+        batch_artifacts (``bool``, optional):
+
+            If set, the artifacts for all affected sections of a batch are
+            requested from ``artifact_source`` at once, as consecutive
+            sections along ``axis``, instead of with one request per section.
+            This is faster, but all artifacts of a batch then come from the
+            same upstream batch (and are thus correlated), and
+            ``artifact_source`` has to provide at least as many sections as a
+            batch has artifact sections. Default is false.
+
         deformation_strength (``int``, optional):
 
             Strength of the slice deformation in voxels, used if
             ``prob_deform`` > 0. The deformation models a fold by shifting the
             section contents towards a randomly oriented line in the section.
-            The line itself will be drawn with a value of 0.
+            The line itself will be drawn with a value of 0. If ``torch`` is
+            installed, the deformation is applied with
+            ``torch.nn.functional.grid_sample``, otherwise with
+            ``scipy.ndimage.map_coordinates``. For interpolatable arrays, the
+            former uses cubic convolution and the latter cubic B-splines, so
+            the deformed sections differ slightly depending on whether
+            ``torch`` is installed.
 
         axis (``int``, optional):
 
@@ -79,6 +124,7 @@ class DefectAugment(BatchFilter):
             artifact_source=None,
             artifacts=None,
             artifacts_mask=None,
+            batch_artifacts=False,
             deformation_strength=20,
             axis=0):
         self.intensities = intensities
@@ -90,6 +136,7 @@ class DefectAugment(BatchFilter):
         self.artifact_source = artifact_source
         self.artifacts = artifacts
         self.artifacts_mask = artifacts_mask
+        self.batch_artifacts = batch_artifacts
         self.deformation_strength = deformation_strength
         self.axis = axis
 
@@ -105,7 +152,7 @@ class DefectAugment(BatchFilter):
 
     # send roi request to data-source upstream
     def prepare(self, request):
-        random.seed(request.random_seed)
+        np.random.seed(request.random_seed)
         deps = BatchRequest()
 
         # we prepare the augmentations, by determining which slices
@@ -114,46 +161,56 @@ class DefectAugment(BatchFilter):
         # we prepare these trafos already
         # and request a bigger roi from upstream
 
-        prob_missing_threshold = self.prob_missing
-        prob_low_contrast_threshold = prob_missing_threshold + self.prob_low_contrast
-        prob_artifact_threshold = prob_low_contrast_threshold + self.prob_artifact
-        prob_deform_slice = prob_artifact_threshold + self.prob_deform
+        # upper bounds of a uniform sample in [0, 1) for each augmentation
+        # type, in the order of the augmentation type constants
+        thresholds = np.cumsum([
+            self.prob_missing,
+            self.prob_low_contrast,
+            self.prob_artifact,
+            self.prob_deform])
 
         spec = request[self.intensities].copy()
         roi = spec.roi
         logger.debug("downstream request ROI is %s" % roi)
         raw_voxel_size = self.spec[self.intensities].voxel_size
 
+        # draw the augmentation type of all sections at once, sections with a
+        # sample above the last threshold are not augmented
+        num_sections = (roi / raw_voxel_size).get_shape()[self.axis]
+        augmentation_types = np.searchsorted(
+            thresholds,
+            np.random.random(num_sections),
+            side='right')
+
         # store the mapping slice to augmentation type in a dict
-        self.slice_to_augmentation = {}
-        # store the transformations for deform slice
-        self.deform_slice_transformations = {}
-        for c in range((roi / raw_voxel_size).get_shape()[self.axis]):
-            r = random.random()
-
-            if r < prob_missing_threshold:
-                logger.debug("Zero-out " + str(c))
-                self.slice_to_augmentation[c] = 'zero_out'
-
-            elif r < prob_low_contrast_threshold:
-                logger.debug("Lower contrast " + str(c))
-                self.slice_to_augmentation[c] = 'lower_contrast'
-
-            elif r < prob_artifact_threshold:
-                logger.debug("Add artifact " + str(c))
-                self.slice_to_augmentation[c] = 'artifact'
-
-            elif r < prob_deform_slice:
-                logger.debug("Add deformed slice " + str(c))
-                self.slice_to_augmentation[c] = 'deformed_slice'
-                # get the shape of a single slice
-                slice_shape = (roi / raw_voxel_size).get_shape()
-                slice_shape = slice_shape[:self.axis] + slice_shape[self.axis+1:]
-                self.deform_slice_transformations[c] = self.__prepare_deform_slice(slice_shape)
+        self.slice_to_augmentation = {
+            c: int(augmentation_type)
+            for c, augmentation_type in enumerate(augmentation_types)
+            if augmentation_type < len(thresholds)
+        }
+        logger.debug("section augmentations: %s", self.slice_to_augmentation)
+
+        # store the transformations for deform slice, stacked in the order of
+        # the deformed slices
+        self.deform_slice_transformations = None
+        # get the shape of a single slice
+        slice_shape = (roi / raw_voxel_size).get_shape()
+        slice_shape = slice_shape[:self.axis] + slice_shape[self.axis+1:]
+        num_deformed = sum(
+            augmentation_type == DEFORMED_SLICE
+            for augmentation_type in self.slice_to_augmentation.values())
+        if num_deformed > 0:
+            flows, line_masks = zip(*(
+                self.__prepare_deform_slice(slice_shape)
+                for _ in range(num_deformed)))
+            flows = np.stack(flows)
+            if not isinstance(torch, NoSuchModule):
+                flows = torch.from_numpy(flows)
+            self.deform_slice_transformations = (flows, np.stack(line_masks))
 
         # prepare transformation and
         # request bigger upstream roi for deformed slice
-        if 'deformed_slice' in self.slice_to_augmentation.values():
+        if DEFORMED_SLICE in self.slice_to_augmentation.values():
 
             # create roi sufficiently large to feed deformation
             logger.debug("before growth: %s" % spec.roi)
@@ -171,93 +228,138 @@ class DefectAugment(BatchFilter):
 
         deps[self.intensities] = spec
 
+        return deps
+
     def process(self, batch, request):
 
         assert batch.get_total_roi().dims() == 3, "defectaugment works on 3d batches only"
 
         raw = batch.arrays[self.intensities]
-        raw_voxel_size = self.spec[self.intensities].voxel_size
 
-        for c, augmentation_type in self.slice_to_augmentation.items():
+        # view on the data with the section axis first, writes to it go to
+        # raw.data
+        sections = np.moveaxis(raw.data, self.axis, 0)
+
+        # augment all sections of one augmentation type at once
+        augmentations = {
+            ZERO_OUT: self.__zero_out,
+            LOWER_CONTRAST: self.__lower_contrast,
+            ARTIFACT: self.__add_artifacts,
+            DEFORMED_SLICE: self.__deform_slices,
+        }
+        for augmentation_type, augment in augmentations.items():
+            indices = np.array([
+                c for c, a in self.slice_to_augmentation.items()
+                if a == augmentation_type
+            ], dtype=int)
+            if len(indices) > 0:
+                augment(sections, indices)
 
-            section_selector = tuple(
-                slice(None if d != self.axis else c, None if d != self.axis else c+1)
+        # in case we needed to change the ROI due to a deformation augment,
+        # restore original ROI and crop the array data
+        if DEFORMED_SLICE in self.slice_to_augmentation.values():
+            old_roi = request[self.intensities].roi
+            logger.debug("resetting roi to %s" % old_roi)
+            crop = tuple(
+                slice(None) if d == self.axis else slice(self.deformation_strength, -self.deformation_strength)
                 for d in range(raw.spec.roi.dims())
             )
+            raw.data = raw.data[crop]
+            raw.spec.roi = old_roi
 
-            if augmentation_type == 'zero_out':
-                raw.data[section_selector] = 0
+        # release the deformation fields of this batch
+        self.deform_slice_transformations = None
 
-            elif augmentation_type == 'low_contrast':
-                section = raw.data[section_selector]
+    def __zero_out(self, sections, indices):
 
-                mean = section.mean()
-                section -= mean
-                section *= self.contrast_scale
-                section += mean
+        sections[indices] = 0
 
-                raw.data[section_selector] = section
+    def __lower_contrast(self, sections, indices):
 
-            elif augmentation_type == 'artifact':
+        section = sections[indices]
 
-                section = raw.data[section_selector]
+        mean = section.mean(axis=(1, 2), keepdims=True)
+        section -= mean
+        section *= self.contrast_scale
+        section += mean
 
-                alpha_voxel_size = self.artifact_source.spec[self.artifacts_mask].voxel_size
+        sections[indices] = section
 
-                assert raw_voxel_size == alpha_voxel_size, ("Can only alpha blend RAW with "
-                                                            "ALPHA_MASK if both have the same "
-                                                            "voxel size")
+    def __add_artifacts(self, sections, indices):
 
-                artifact_request = BatchRequest()
-                artifact_request.add(self.artifacts, Coordinate(section.shape) * raw_voxel_size, voxel_size=raw_voxel_size)
-                artifact_request.add(self.artifacts_mask, Coordinate(section.shape) * alpha_voxel_size, voxel_size=raw_voxel_size)
-                logger.debug("Requesting artifact batch %s", artifact_request)
+        raw_voxel_size = self.spec[self.intensities].voxel_size
+        alpha_voxel_size = self.artifact_source.spec[self.artifacts_mask].voxel_size
 
-                artifact_batch = self.artifact_source.request_batch(artifact_request)
-                artifact_alpha = artifact_batch.arrays[self.artifacts_mask].data
-                artifact_raw   = artifact_batch.arrays[self.artifacts].data
+        assert raw_voxel_size == alpha_voxel_size, ("Can only alpha blend RAW with "
+                                                    "ALPHA_MASK if both have the same "
+                                                    "voxel size")
 
-                assert artifact_alpha.dtype == np.float32
-                assert artifact_alpha.min() >= 0.0
-                assert artifact_alpha.max() <= 1.0
+        if self.batch_artifacts:
+            # request the artifacts for all sections at once, stacked along
+            # the section axis
+            artifact_raw, artifact_alpha = self.__request_artifacts(
+                sections.shape[1:], len(indices))
+        else:
+            # request the artifacts for each section independently
+            artifact_raw, artifact_alpha = (
+                np.concatenate(arrays)
+                for arrays in zip(*(
+                    self.__request_artifacts(sections.shape[1:], 1)
+                    for _ in indices)))
+
+        # blend as section + alpha*(artifact - section), in place on a single
+        # temporary
+        section = sections[indices]
+        blended = np.subtract(
+            artifact_raw,
+            section,
+            dtype=np.result_type(section, artifact_raw, artifact_alpha))
+        blended *= artifact_alpha
+        blended += section
+        sections[indices] = blended
+
+    def __request_artifacts(self, section_shape, num_sections):
 
-                raw.data[section_selector] = section*(1.0 - artifact_alpha) + artifact_raw*artifact_alpha
+        raw_voxel_size = self.spec[self.intensities].voxel_size
+        alpha_voxel_size = self.artifact_source.spec[self.artifacts_mask].voxel_size
 
-            elif augmentation_type == 'deformed_slice':
+        artifacts_shape = list(section_shape)
+        artifacts_shape.insert(self.axis, num_sections)
+        artifacts_shape = Coordinate(artifacts_shape)
 
-                section = raw.data[section_selector].squeeze()
+        artifact_request = BatchRequest()
+        artifact_request.add(self.artifacts, artifacts_shape * raw_voxel_size, voxel_size=raw_voxel_size)
+        artifact_request.add(self.artifacts_mask, artifacts_shape * alpha_voxel_size, voxel_size=raw_voxel_size)
+        logger.debug("Requesting artifact batch %s", artifact_request)
 
-                # set interpolation to cubic, spec interploatable is true, else to 0
-                interpolation = 3 if self.spec[self.intensities].interpolatable else 0
+        artifact_batch = self.artifact_source.request_batch(artifact_request)
+        artifact_alpha = np.moveaxis(
+            artifact_batch.arrays[self.artifacts_mask].data, self.axis, 0)
+        artifact_raw = np.moveaxis(
+            artifact_batch.arrays[self.artifacts].data, self.axis, 0)
 
-                # load the deformation fields that were prepared for this slice
-                flow_x, flow_y, line_mask = self.deform_slice_transformations[c]
+        assert artifact_alpha.dtype == np.float32
+        assert artifact_alpha.min() >= 0.0
+        assert artifact_alpha.max() <= 1.0
 
-                # apply the deformation fields
-                shape = section.shape
-                section = map_coordinates(
-                    section, (flow_y, flow_x), mode='constant', order=interpolation
-                ).reshape(shape)
+        return artifact_raw, artifact_alpha
 
-                # things can get smaller than 0 at the boundary, so we clip
-                section = np.clip(section, 0., 1.)
+    def __deform_slices(self, sections, indices):
 
-                # zero-out data below the line mask
-                section[line_mask] = 0.
+        # load the deformation fields that were prepared for these slices, in
+        # the same order
+        flows, line_masks = self.deform_slice_transformations
 
-                raw.data[section_selector] = section
+        # apply the deformation fields
+        section = self.__warp_sections(sections[indices], flows)
 
-        # in case we needed to change the ROI due to a deformation augment,
-        # restore original ROI and crop the array data
-        if 'deformed_slice' in self.slice_to_augmentation.values():
-            old_roi = request[self.intensities].roi
-            logger.debug("resetting roi to %s" % old_roi)
-            crop = tuple(
-                slice(None) if d == self.axis else slice(self.deformation_strength, -self.deformation_strength)
-                for d in range(raw.spec.roi.dims())
-            )
-            raw.data = raw.data[crop]
-            raw.spec.roi = old_roi
+        # things can get smaller than 0 at the boundary, so we clip
+        np.clip(section, 0., 1., out=section)
+
+        # zero-out data below the line mask
+        section[line_masks] = 0.
+
+        sections[indices] = section
 
     def __prepare_deform_slice(self, slice_shape):
 
@@ -266,7 +368,7 @@ class DefectAugment(BatchFilter):
         shape = (slice_shape[0] + grow_by, slice_shape[1] + grow_by)
 
         # randomly choose fixed x or fixed y with p = 1/2
-        fixed_x = random.random() < .5
+        fixed_x = np.random.random() < .5
         if fixed_x:
             x0, y0 = 0, np.random.randint(1, shape[1] - 2)
             x1, y1 = shape[0] - 1, np.random.randint(1, shape[1] - 2)
@@ -288,27 +390,60 @@ class DefectAugment(BatchFilter):
         normal_vector[0] = - line_vector[1]
         normal_vector[1] = line_vector[0]
 
-        # make meshgrid
-        x, y = np.meshgrid(np.arange(shape[1]), np.arange(shape[0]))
-        # generate the vector field
-        flow_x, flow_y = np.zeros(shape), np.zeros(shape)
-
-        # find the 2 components where coordinates are bigger / smaller than the line
-        # to apply normal vector in the correct direction
-        components, n_components = label(np.logical_not(line_mask).view('uint8'))
-        assert n_components == 2, "%i" % n_components
-        neg_val = components[0, 0] if fixed_x else components[-1, -1]
-        pos_val = components[-1, -1] if fixed_x else components[0, 0]
-
-        flow_x[components == pos_val] = self.deformation_strength * normal_vector[1]
-        flow_y[components == pos_val] = self.deformation_strength * normal_vector[0]
-        flow_x[components == neg_val] = - self.deformation_strength * normal_vector[1]
-        flow_y[components == neg_val] = - self.deformation_strength * normal_vector[0]
-
         # generate the flow fields
-        flow_x, flow_y = (x + flow_x).reshape(-1, 1), (y + flow_y).reshape(-1, 1)
-
-        # dilate the line mask
-        line_mask = binary_dilation(line_mask, iterations=10)
-
-        return flow_x, flow_y, line_mask
+        flow = _fill_flow(
+            shape,
+            (x0, y0),
+            (x1, y1),
+            normal_vector,
+            self.deformation_strength)
+
+        # dilate the line mask, only within the bounding box of the line grown
+        # by the dilation radius (nothing changes outside of it)
+        radius = 10
+        bounding_box = tuple(
+            slice(max(0, min(a, b) - radius), max(a, b) + radius + 1)
+            for a, b in ((x0, x1), (y0, y1))
+        )
+        line_mask[bounding_box] = binary_dilation(
+            line_mask[bounding_box], iterations=radius)
+
+        if isinstance(torch, NoSuchModule):
+            return flow, line_mask
+
+        # grid_sample expects a (H, W, 2) grid of (x, y) sample coordinates
+        # per section, normalized to [-1, 1]
+        grid = np.empty(shape + (2,), dtype=np.float32)
+        grid[..., 0] = 2.0 * flow[1] / (shape[1] - 1) - 1
+        grid[..., 1] = 2.0 * flow[0] / (shape[0] - 1) - 1
+
+        return grid, line_mask
+
+    def __warp_sections(self, sections, flows):
+
+        interpolatable = self.spec[self.intensities].interpolatable
+
+        if isinstance(torch, NoSuchModule):
+
+            # set interpolation to cubic, spec interploatable is true, else to 0
+            interpolation = 3 if interpolatable else 0
+
+            return np.stack([
+                map_coordinates(
+                    section, flow, mode='constant', order=interpolation)
+                for section, flow in zip(sections, flows)
+            ])
+
+        # warp all sections with a single call, using the batch dimension
+        sections = torch.from_numpy(
+            np.ascontiguousarray(sections, dtype=np.float32)
+        ).unsqueeze(1)
+
+        sections = torch.nn.functional.grid_sample(
+            sections,
+            flows,
+            mode='bicubic' if interpolatable else 'nearest',
+            padding_mode='zeros',
+            align_corners=True)
+
+        return sections[:, 0].numpy()
@@ -1,4 +1,3 @@
-import copy
 from .coordinate import Coordinate
 from .freezable import Freezable
 import numbers
@@ -325,7 +324,7 @@ class Roi(Freezable):
 
     def copy(self):
         '''Create a copy of this ROI.'''
-        return copy.deepcopy(self)
+        return Roi(self.__offset, self.__shape)
 
     def __left_min(self, x, y):
 
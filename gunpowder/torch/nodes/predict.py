@@ -4,6 +4,7 @@ from gunpowder.ext import torch
 from gunpowder.nodes.generic_predict import GenericPredict
 
 import logging
+import numpy as np
 from typing import Dict, Union
 
 logger = logging.getLogger(__name__)
@@ -53,6 +54,21 @@ class Predict(GenericPredict):
 
         spawn_subprocess (bool, optional): Whether to run ``predict`` in a
             separate process. Default is false.
+
+        mixed_precision (``bool``, optional):
+
+            Whether to run the forward pass in ``float16`` under
+            ``torch.autocast``. Models without 5D parameters (i.e., without 3D
+            convolutions) and their 4D inputs are additionally converted to
+            ``channels_last`` memory format. Only used when predicting on the
+            GPU. Floating point outputs are converted back to ``float32``.
+            Default is false.
+
+        compile_model (``bool``, optional):
+
+            Whether to compile the model with ``torch.compile`` (requires torch
+            2.0 or later) before the first prediction. Compilation can take a
+            while, but speeds up subsequent forward passes. Default is false.
     """
 
     def __init__(
@@ -63,7 +79,9 @@ class Predict(GenericPredict):
         array_specs: Dict[ArrayKey, ArraySpec] = None,
         checkpoint: str = None,
         device="cuda",
-        spawn_subprocess=False
+        spawn_subprocess=False,
+        mixed_precision=False,
+        compile_model=False
     ):
 
         self.array_specs = array_specs if array_specs is not None else {}
@@ -71,7 +89,7 @@ class Predict(GenericPredict):
         if model.training:
             logger.warning(
                 "Model is in training mode during prediction. "
-                "Consider using model.eval()"
+                "It will be switched to evaluation mode with model.eval()"
             )
 
         super(Predict, self).__init__(
@@ -84,10 +102,17 @@ class Predict(GenericPredict):
         self.device = None  # to be set in start()
         self.model = model
         self.checkpoint = checkpoint
+        self.mixed_precision = mixed_precision
+        self.compile_model = compile_model
 
         self.intermediate_layers = {}
         self.register_hooks()
 
+        # page-locked host and device buffers for the inputs, by input name,
+        # reused as long as the input shapes don't change
+        self.input_buffers = {}
+        self.copy_stream = None
+
     def start(self):
 
         self.use_cuda = (
@@ -95,6 +120,12 @@ class Predict(GenericPredict):
             self.device_string == "cuda")
         logger.info(f"Predicting on {'gpu' if self.use_cuda else 'cpu'}")
         self.device = torch.device("cuda" if self.use_cuda else "cpu")
+        self.use_amp = self.mixed_precision and self.use_cuda
+        self.channels_last = False
+
+        if self.use_cuda:
+            # side stream to copy inputs to and outputs from the GPU
+            self.copy_stream = torch.cuda.Stream(device=self.device)
 
         try:
             self.model = self.model.to(self.device)
@@ -105,27 +136,117 @@ class Predict(GenericPredict):
                 "your model to device in the main process."
             ) from e
 
+        # disable dropout and batch norm statistics updates
+        self.model.eval()
+
         if self.checkpoint is not None:
             checkpoint = torch.load(self.checkpoint, map_location=self.device)
             if "model_state_dict" in checkpoint:
                 self.model.load_state_dict(checkpoint["model_state_dict"])
             else:
-                self.model.load_state_dict()
+                self.model.load_state_dict(checkpoint)
+
+        if self.use_amp:
+            self.channels_last = self.convert_to_channels_last()
+
+        if self.compile_model:
+            if hasattr(torch, "compile"):
+                self.model = torch.compile(
+                    self.model,
+                    mode="reduce-overhead",
+                    fullgraph=False)
+            else:
+                logger.warning(
+                    "compile_model is set, but torch.compile is not available "
+                    "in torch %s, predicting with the uncompiled model",
+                    torch.__version__)
+
+    def convert_to_channels_last(self):
+        """Convert the model to ``channels_last`` memory format, unless it has
+        5D parameters or buffers (e.g., of 3D convolutions), for which this
+        format is not defined. Returns whether the model was converted."""
+
+        tensors = list(self.model.parameters()) + list(self.model.buffers())
+        if any(tensor.dim() == 5 for tensor in tensors):
+            logger.info(
+                "model has 5D parameters, not converting it to channels_last")
+            return False
+
+        self.model = self.model.to(memory_format=torch.channels_last)
+        return True
 
     def predict(self, batch, request):
         inputs = self.get_inputs(batch)
         with torch.no_grad():
-            out = self.model.forward(**inputs)
+            with torch.autocast(
+                    "cuda",
+                    dtype=torch.float16,
+                    enabled=self.use_amp):
+                out = self.model.forward(**inputs)
         outputs = self.get_outputs(out, request)
         self.update_batch(batch, request, outputs)
 
     def get_inputs(self, batch):
-        model_inputs = {
-            key: torch.as_tensor(batch[value].data, device=self.device)
-            for key, value in self.inputs.items()
-        }
+
+        if not self.use_cuda:
+            # torch can't view arrays with negative strides (e.g., mirrored
+            # views), those are copied
+            model_inputs = {
+                key: torch.as_tensor(
+                    np.ascontiguousarray(batch[value].data),
+                    device=self.device)
+                for key, value in self.inputs.items()
+            }
+            return model_inputs
+
+        # stage the inputs in page-locked memory, such that the copies to the
+        # GPU can run asynchronously on the side stream (the buffers are free
+        # to reuse, the outputs of the previous batch were already copied back
+        # to the host)
+        model_inputs = {}
+        with torch.cuda.stream(self.copy_stream):
+            for key, value in self.inputs.items():
+                data = batch[value].data
+                pinned, device_input = self.get_input_buffers(key, data)
+                np.copyto(pinned.numpy(), data)
+                device_input.copy_(pinned, non_blocking=True)
+                model_inputs[key] = device_input
+
+        # the model has to wait for the copies to finish
+        torch.cuda.current_stream(self.device).wait_stream(self.copy_stream)
+
         return model_inputs
 
+    def get_input_buffers(self, key, data):
+
+        buffers = self.input_buffers.get(key)
+
+        if (
+                buffers is None or
+                buffers[0].shape != data.shape or
+                buffers[0].numpy().dtype != data.dtype):
+
+            # allocate from shape and dtype only, data itself might not be
+            # viewable as a tensor (e.g., mirrored views with negative
+            # strides), np.copyto takes care of the strided copy
+            pinned = torch.empty(
+                data.shape,
+                dtype=torch.from_numpy(np.empty(0, dtype=data.dtype)).dtype,
+                pin_memory=True)
+            if self.channels_last and pinned.dim() == 4:
+                memory_format = torch.channels_last
+            else:
+                memory_format = torch.contiguous_format
+            device_input = torch.empty_like(
+                pinned,
+                device=self.device,
+                memory_format=memory_format)
+
+            buffers = (pinned, device_input)
+            self.input_buffers[key] = buffers
+
+        return buffers
+
     def register_hooks(self):
         for key in self.outputs:
             if isinstance(key, str):
@@ -150,13 +271,42 @@ class Predict(GenericPredict):
                     outputs[value] = self.intermediate_layers[key]
                 elif isinstance(key, int):
                     outputs[value] = module_outs[key]
+                if self.use_amp and outputs[value].dtype == torch.float16:
+                    outputs[value] = outputs[value].float()
         return outputs
 
     def update_batch(self, batch, request, requested_outputs):
+        if self.use_cuda:
+            requested_outputs = self.copy_to_host(requested_outputs)
         for array_key, tensor in requested_outputs.items():
             spec = self.spec[array_key].copy()
             spec.roi = request[array_key].roi
-            batch.arrays[array_key] = Array(tensor.cpu().detach().numpy(), spec)
+            batch.arrays[array_key] = Array(
+                tensor.cpu().detach().numpy(),
+                spec)
+
+    def copy_to_host(self, device_outputs):
+
+        # queue the copies of all outputs into page-locked host memory on the
+        # side stream, once the model computed them, and wait for all of them
+        # at once
+        self.copy_stream.wait_stream(torch.cuda.current_stream(self.device))
+        host_outputs = {}
+        with torch.cuda.stream(self.copy_stream):
+            for array_key, tensor in device_outputs.items():
+                host_outputs[array_key] = torch.empty(
+                    tensor.shape,
+                    dtype=tensor.dtype,
+                    pin_memory=True)
+                host_outputs[array_key].copy_(
+                    tensor.detach(),
+                    non_blocking=True)
+        self.copy_stream.synchronize()
+
+        return host_outputs
 
     def stop(self):
-        pass
+
+        # release the page-locked host and device buffers and the copy stream
+        self.input_buffers = {}
+        self.copy_stream = None
@@ -0,0 +1,206 @@
+from .provider_test import ProviderTest
+from gunpowder import (
+    BatchProvider,
+    BatchRequest,
+    Batch,
+    ArraySpec,
+    ArrayKey,
+    Array,
+    Roi,
+    DefectAugment,
+    build,
+)
+from gunpowder.ext import NoSuchModule
+from unittest import mock
+
+import numpy as np
+
+
+class ExampleDefectSource(BatchProvider):
+    def __init__(self, key):
+        self.key = key
+
+    def setup(self):
+
+        self.provides(
+            self.key,
+            ArraySpec(
+                roi=Roi((0, 0, 0), (10, 100, 100)),
+                voxel_size=(1, 1, 1),
+                dtype=np.float32,
+                interpolatable=True,
+            ),
+        )
+
+    def provide(self, request):
+
+        spec = self.spec[self.key].copy()
+        spec.roi = request[self.key].roi
+
+        # alternating columns of 0.25 and 0.75
+        data = np.full(spec.roi.get_shape(), 0.25, dtype=np.float32)
+        data[:, :, spec.roi.get_begin()[2] % 2::2] = 0.75
+
+        batch = Batch()
+        batch.arrays[self.key] = Array(data, spec)
+        return batch
+
+
+class ExampleArtifactSource(BatchProvider):
+    def __init__(self, artifacts, artifacts_mask, num_sections=10):
+        self.artifacts = artifacts
+        self.artifacts_mask = artifacts_mask
+        self.num_sections = num_sections
+        self.num_requests = 0
+
+    def setup(self):
+
+        spec = ArraySpec(
+            roi=Roi((0, 0, 0), (self.num_sections, 100, 100)),
+            voxel_size=(1, 1, 1),
+            dtype=np.float32,
+            interpolatable=True,
+        )
+        self.provides(self.artifacts, spec)
+        self.provides(self.artifacts_mask, spec.copy())
+
+    def provide(self, request):
+
+        self.num_requests += 1
+
+        batch = Batch()
+        for key, value in [(self.artifacts, 1.0), (self.artifacts_mask, 0.5)]:
+            spec = self.spec[key].copy()
+            spec.roi = request[key].roi
+            data = np.full(spec.roi.get_shape(), value, dtype=np.float32)
+            batch.arrays[key] = Array(data, spec)
+        return batch
+
+
+class TestDefectAugment(ProviderTest):
+    def test_zero_out(self):
+
+        raw = ArrayKey("RAW")
+
+        pipeline = ExampleDefectSource(raw) + DefectAugment(
+            raw, prob_missing=1.0, prob_low_contrast=0.0
+        )
+
+        request = BatchRequest()
+        request[raw] = ArraySpec(roi=Roi((0, 20, 20), (10, 20, 20)))
+
+        with build(pipeline):
+            batch = pipeline.request_batch(request)
+
+        assert batch[raw].spec.roi == request[raw].roi
+        assert np.all(batch[raw].data == 0)
+
+    def test_lower_contrast(self):
+
+        raw = ArrayKey("RAW")
+
+        pipeline = ExampleDefectSource(raw) + DefectAugment(
+            raw, prob_missing=0.0, prob_low_contrast=1.0, contrast_scale=0.1
+        )
+
+        request = BatchRequest()
+        request[raw] = ArraySpec(roi=Roi((0, 20, 20), (10, 20, 20)))
+
+        with build(pipeline):
+            batch = pipeline.request_batch(request)
+
+        data = batch[raw].data
+        assert np.allclose(data.mean(axis=(1, 2)), 0.5)
+        assert np.allclose(data.min(), 0.475)
+        assert np.allclose(data.max(), 0.525)
+
+    def request_artifacts(self, num_artifact_sections, batch_artifacts):
+
+        raw = ArrayKey("RAW")
+        artifacts = ArrayKey("ARTIFACTS")
+        artifacts_mask = ArrayKey("ARTIFACTS_MASK")
+
+        artifact_source = ExampleArtifactSource(
+            artifacts, artifacts_mask, num_artifact_sections)
+
+        pipeline = ExampleDefectSource(raw) + DefectAugment(
+            raw,
+            prob_missing=0.0,
+            prob_low_contrast=0.0,
+            prob_artifact=1.0,
+            artifact_source=artifact_source,
+            artifacts=artifacts,
+            artifacts_mask=artifacts_mask,
+            batch_artifacts=batch_artifacts,
+        )
+
+        request = BatchRequest()
+        request[raw] = ArraySpec(roi=Roi((0, 20, 20), (10, 20, 20)))
+
+        with build(pipeline):
+            batch = pipeline.request_batch(request)
+
+        # alternating 0.75 and 0.25, blended with 1.0 at alpha 0.5
+        data = batch[raw].data
+        assert np.allclose(data[:, :, 0::2], 0.875)
+        assert np.allclose(data[:, :, 1::2], 0.625)
+
+        return artifact_source.num_requests
+
+    def test_artifact(self):
+
+        # one independent request per section
+        assert self.request_artifacts(10, batch_artifacts=False) == 10
+
+        # the artifact source has fewer sections than the batch
+        assert self.request_artifacts(1, batch_artifacts=False) == 10
+
+    def test_batch_artifacts(self):
+
+        # artifacts for all sections are requested at once
+        assert self.request_artifacts(10, batch_artifacts=True) == 1
+
+    def test_deform(self):
+
+        self.check_deform()
+
+    def test_deform_without_torch(self):
+
+        # fall back to scipy.ndimage.map_coordinates
+        try:
+            import no_such_module  # noqa: F401
+        except ImportError:
+            no_torch = NoSuchModule("torch")
+
+        with mock.patch("gunpowder.nodes.defect_augment.torch", no_torch):
+            self.check_deform()
+
+    def check_deform(self):
+
+        raw = ArrayKey("RAW")
+
+        pipeline = ExampleDefectSource(raw) + DefectAugment(
+            raw,
+            prob_missing=0.0,
+            prob_low_contrast=0.0,
+            prob_deform=1.0,
+            deformation_strength=5,
+        )
+
+        request = BatchRequest()
+        request[raw] = ArraySpec(roi=Roi((0, 20, 20), (10, 40, 40)))
+
+        with build(pipeline):
+            for i in range(10):
+                batch = pipeline.request_batch(request)
+
+                data = batch[raw].data
+                assert batch[raw].spec.roi == request[raw].roi
+                assert data.shape == (10, 40, 40)
+                assert data.min() >= 0.0 and data.max() <= 1.0
+
+                for section in data:
+                    # each section got a blacked-out fold line, content
+                    # elsewhere is preserved
+                    assert np.any(section == 0.0)
+                    assert np.any(section > 0.0)
@@ -88,6 +88,34 @@ class ExampleTorchTrainSource(BatchProvider):
         return batch
 
 
+class ExampleTorchPredictMirroredSource(BatchProvider):
+    def setup(self):
+
+        spec = ArraySpec(
+            roi=Roi((0, 0), (17, 17)),
+            dtype=np.float32,
+            interpolatable=True,
+            voxel_size=(1, 1),
+        )
+        self.provides(ArrayKeys.A, spec)
+
+    def provide(self, request):
+
+        batch = Batch()
+
+        spec = self.spec[ArrayKeys.A].copy()
+        spec.roi = request[ArrayKeys.A].roi
+
+        # a mirrored view, with negative strides, with sample and channel
+        # dimensions to get a 4D model input
+        shape = (1, 1) + spec.roi.get_shape()
+        x = np.arange(np.prod(shape), dtype=np.float32).reshape(shape)
+        x /= x.size
+        batch.arrays[ArrayKeys.A] = Array(x[..., ::-1, ::-1], spec)
+
+        return batch
+
+
 @skipIf(isinstance(torch, NoSuchModule), "torch is not installed")
 class TestTorchTrain(ProviderTest):
     def test_output(self):
@@ -226,6 +254,128 @@ class TestTorchPredict(ProviderTest):
             assert np.isclose(batch1[c_pred].data, 1 + 4 + 9)
             assert np.isclose(batch2[d_pred].data, 2 * (1 + 4 + 9))
 
+    def test_eval(self):
+
+        a = ArrayKey("A")
+        b = ArrayKey("B")
+        c_pred = ArrayKey("C_PREDICTED")
+
+        class ExampleModel(torch.nn.Module):
+            def __init__(self):
+                super(ExampleModel, self).__init__()
+                self.linear = torch.nn.Linear(4, 1, False)
+                self.linear.weight.data = torch.Tensor([1, 1, 1, 1])
+                self.dropout = torch.nn.Dropout(p=0.5)
+
+            def forward(self, a, b):
+                a = a.reshape(-1)
+                b = b.reshape(-1)
+                return self.linear(self.dropout(a * b))
+
+        # left in training mode, Predict has to switch to evaluation mode
+        model = ExampleModel()
+
+        source = ExampleTorchTrainSource()
+        predict = Predict(
+            model=model,
+            inputs={"a": a, "b": b},
+            outputs={0: c_pred},
+            array_specs={c_pred: ArraySpec(nonspatial=True)},
+        )
+        pipeline = source + predict
+
+        request = BatchRequest(
+            {
+                a: ArraySpec(roi=Roi((0, 0), (2, 2))),
+                b: ArraySpec(roi=Roi((0, 0), (2, 2))),
+                c_pred: ArraySpec(nonspatial=True),
+            }
+        )
+
+        with build(pipeline):
+
+            for i in range(10):
+                batch = pipeline.request_batch(request)
+                assert np.isclose(batch[c_pred].data, 1 + 4 + 9)
+
+    def test_channels_last(self):
+
+        a = ArrayKey("A")
+        c_pred = ArrayKey("C_PREDICTED")
+
+        # 3D convolutions have 5D weights, which can't be channels_last
+        predict = Predict(
+            model=torch.nn.Conv3d(1, 2, 3),
+            inputs={"input": a},
+            outputs={0: c_pred},
+            mixed_precision=True,
+        )
+        assert not predict.convert_to_channels_last()
+        assert predict.model.weight.is_contiguous()
+
+        predict = Predict(
+            model=torch.nn.Conv2d(1, 2, 3),
+            inputs={"input": a},
+            outputs={0: c_pred},
+            mixed_precision=True,
+        )
+        assert predict.convert_to_channels_last()
+        assert predict.model.weight.is_contiguous(
+            memory_format=torch.channels_last)
+
+    @skipIf(not torch.cuda.is_available(), "CUDA is not available")
+    def test_cuda(self):
+
+        a = ArrayKey("A")
+        pred = ArrayKey("PRED")
+
+        model = torch.nn.Conv2d(1, 1, 3)
+
+        # the same input shape twice to reuse the input buffers, then a new
+        # shape to reallocate them
+        requests = [
+            BatchRequest(
+                {
+                    a: ArraySpec(roi=Roi((0, 0), (size, size))),
+                    pred: ArraySpec(roi=Roi((1, 1), (size - 2, size - 2))),
+                }
+            )
+            for size in (7, 7, 9)
+        ]
+
+        def predict(device, mixed_precision=False):
+
+            pipeline = ExampleTorchPredictMirroredSource() + Predict(
+                model=model,
+                inputs={"input": a},
+                outputs={0: pred},
+                array_specs={pred: ArraySpec()},
+                device=device,
+                mixed_precision=mixed_precision,
+            )
+
+            with build(pipeline):
+                return [
+                    pipeline.request_batch(request)[pred].data
+                    for request in requests
+                ]
+
+        cpu_outputs = predict("cpu")
+        cuda_outputs = predict("cuda")
+        amp_outputs = predict("cuda", mixed_precision=True)
+
+        # outputs are copied back to the host through page-locked memory
+        for cpu_output, cuda_output in zip(cpu_outputs, cuda_outputs):
+            assert cuda_output.dtype == np.float32
+            assert cuda_output.shape == cpu_output.shape
+            assert np.allclose(cpu_output, cuda_output, atol=1e-3)
+
+        # float16 outputs of the forward pass are converted to float32
+        for cpu_output, amp_output in zip(cpu_outputs, amp_outputs):
+            assert amp_output.dtype == np.float32
+            assert amp_output.shape == cpu_output.shape
+            assert np.allclose(cpu_output, amp_output, atol=1e-2)
+
 
 class ExampleModel(torch.nn.Module):
     def __init__(self):